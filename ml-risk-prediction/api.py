@@ -3,69 +3,393 @@ Flask API for Stock Risk Prediction
 Serves risk predictions to Salesforce via REST API
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request
 from flask_cors import CORS
-import joblib
 import numpy as np
+from numba import njit
+import onnxruntime as ort
+import msgspec
+import orjson
+import treelite_runtime
+import ctypes
 import json
 import os
+import queue
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import islice
+from concurrent.futures import Future
+from typing import List, Optional
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Salesforce calls
 
-# Load model and scaler
-MODEL_PATH = 'models/risk_model.pkl'
-SCALER_PATH = 'models/scaler.pkl'
+# Load model
+MODEL_PATH = 'models/risk_model.onnx'
+COMPILED_MODEL_PATH = 'models/risk_model.so'
+SCORE_LIB_PATH = 'models/risk_model_score.so'
 FEATURE_NAMES_PATH = 'models/feature_names.json'
 
+# Feature schema the model is trained on, in column order (see train_model.py)
+FEATURE_COLUMNS = [
+    'day_change_percent',
+    'volume',
+    'market_cap',
+    'current_price',
+    'price_volatility',
+    'volume_ratio',
+    'price_change_ratio'
+]
+
+# Raw inputs used to build the features, in column order
+RAW_KEYS = [
+    'day_change_percent',
+    'volume',
+    'market_cap',
+    'current_price',
+    'previous_close'
+]
+
+# Risk score thresholds (0-100) and the level each bucket maps to
+RISK_THRESHOLDS = [30.0, 60.0]
+RISK_LEVELS = ['Low', 'Medium', 'High']
+_RISK_LEVELS_ARRAY = np.array(RISK_LEVELS)  # For bucketing whole batches
+
 try:
-    model = joblib.load(MODEL_PATH)
-    scaler = joblib.load(SCALER_PATH)
+    # gunicorn already runs a worker per core, so keep ONNX Runtime single-threaded
+    session_options = ort.SessionOptions()
+    session_options.intra_op_num_threads = 1
+    session_options.inter_op_num_threads = 1
+    model = ort.InferenceSession(
+        MODEL_PATH, session_options, providers=['CPUExecutionProvider']
+    )
+    model_input_name = model.get_inputs()[0].name
     with open(FEATURE_NAMES_PATH, 'r') as f:
         feature_names = json.load(f)
+    # Rows are built in FEATURE_COLUMNS order, so the model must match it
+    if feature_names != FEATURE_COLUMNS:
+        raise ValueError(f"Unexpected feature names {feature_names}, retrain the model")
     print("Model loaded successfully")
 except Exception as e:
     print(f"Error loading model: {e}")
     model = None
-    scaler = None
+    model_input_name = None
     feature_names = []
 
-def calculate_features(stock_data):
+# Prefer the Treelite-compiled model when it was built (see train_model.py)
+try:
+    compiled_model = treelite_runtime.Predictor(COMPILED_MODEL_PATH, nthread=1)
+    print("Compiled model loaded successfully")
+except Exception as e:
+    print(f"Compiled model not available, using ONNX Runtime: {e}")
+    compiled_model = None
+
+# Single-row scoring function generated by m2cgen, used by /predict
+try:
+    score_lib = ctypes.CDLL(os.path.abspath(SCORE_LIB_PATH))
+    score_lib.score.argtypes = [ctypes.POINTER(ctypes.c_double)]
+    score_lib.score.restype = ctypes.c_double
+    ScoreInput = ctypes.c_double * len(FEATURE_COLUMNS)
+    print("Scoring library loaded successfully")
+except Exception as e:
+    print(f"Scoring library not available, batching /predict calls: {e}")
+    score_lib = None
+
+# Per-thread input buffer for score_lib, filled in place on every call
+_score_input = threading.local()
+
+def score_single(feature_vector):
+    """
+    Score one row in FEATURE_COLUMNS order with the m2cgen scoring library
+    """
+    buffer = getattr(_score_input, 'buffer', None)
+    if buffer is None:
+        buffer = _score_input.buffer = ScoreInput()
+    buffer[:] = feature_vector
+    return score_lib.score(buffer)
+
+class Stock(msgspec.Struct):
+    """
+    Raw stock values of a prediction request, validated while decoding
+    """
+    day_change_percent: float = 0.0
+    volume: float = 0.0
+    market_cap: float = 0.0
+    current_price: float = 0.0
+    previous_close: Optional[float] = None  # Defaults to current_price
+    symbol: str = 'UNKNOWN'
+
+class BatchRequest(msgspec.Struct):
+    """
+    Body of a batch prediction request
+    """
+    stocks: List[Stock] = msgspec.field(default_factory=list)
+
+def raw_stock_values(stock):
+    """
+    Extract the raw numeric inputs of a Stock in RAW_KEYS order
+    """
+    previous_close = stock.previous_close
+    return (
+        stock.day_change_percent,
+        stock.volume,
+        stock.market_cap,
+        stock.current_price,
+        stock.current_price if previous_close is None else previous_close
+    )
+
+def build_row(raw_values):
+    """
+    Calculate derived features from raw stock values (see raw_stock_values)
+    as a tuple in FEATURE_COLUMNS order
+    """
+    (day_change_percent, volume, market_cap,
+     current_price, previous_close) = raw_values
+    
+    return (
+        day_change_percent,
+        volume if volume > 0 else 1,  # Avoid division by zero
+        market_cap if market_cap > 0 else 1,
+        current_price if current_price > 0 else 1,
+        abs(day_change_percent),  # Price volatility
+        # Volume ratio (normalized, using a simple approach)
+        # In production, use historical average
+        1.0,
+        # Price change ratio
+        abs(current_price - previous_close) / previous_close if previous_close > 0 else 0
+    )
+
+@njit(fastmath=True, cache=True)
+def _featurize(raw, out):
+    """
+    Fill out (N, len(FEATURE_COLUMNS)) from raw (N, len(RAW_KEYS)) in a
+    single native pass; same features as build_row
+    """
+    for i in range(raw.shape[0]):
+        day_change_percent = raw[i, 0]
+        volume = raw[i, 1]
+        market_cap = raw[i, 2]
+        current_price = raw[i, 3]
+        previous_close = raw[i, 4]
+        
+        out[i, 0] = day_change_percent
+        out[i, 1] = volume if volume > 0 else 1.0  # Avoid division by zero
+        out[i, 2] = market_cap if market_cap > 0 else 1.0
+        out[i, 3] = current_price if current_price > 0 else 1.0
+        out[i, 4] = abs(day_change_percent)  # Price volatility
+        out[i, 5] = 1.0  # Volume ratio
+        # Price change ratio, 0 where there is no previous close
+        if previous_close > 0:
+            out[i, 6] = abs(current_price - previous_close) / previous_close
+        else:
+            out[i, 6] = 0.0
+
+def calculate_features_batch(raw):
+    """
+    Calculate derived features for a whole batch at once.
+    Takes an (N, len(RAW_KEYS)) array of raw values and returns the
+    (N, len(FEATURE_COLUMNS)) float32 feature matrix.
+    """
+    raw = np.ascontiguousarray(raw, dtype=np.float64).reshape(-1, len(RAW_KEYS))
+    # Allocated C-contiguous like the model expects
+    feat_matrix = np.empty((len(raw), len(FEATURE_COLUMNS)), dtype=np.float32, order='C')
+    _featurize(raw, feat_matrix)
+    return feat_matrix
+
+# Compile the kernel at import, so with preload_app it happens once in the
+# gunicorn master rather than on the first request of every worker
+calculate_features_batch([(0.0,) * len(RAW_KEYS)])
+
+# Largest matrix handed to the model in one call; bigger batches are split
+# so each call's working set stays cache-sized
+PREDICT_CHUNK_SIZE = 512
+
+# Largest /predict/batch request accepted, larger ones get a 413
+MAX_BATCH_STOCKS = 10000
+
+def _run_model(feat_matrix):
+    if compiled_model is not None:
+        return compiled_model.predict(treelite_runtime.DMatrix(feat_matrix)).ravel()
+    return model.run(None, {model_input_name: feat_matrix})[0].ravel()
+
+def predict_scores(feat_matrix):
+    """
+    Run the model on an (N, p) float32 feature matrix and return N risk scores
+    """
+    # No-op for matrices built here; otherwise one copy here rather than
+    # a hidden one inside the model runtime
+    feat_matrix = np.ascontiguousarray(feat_matrix, dtype=np.float32)
+    if len(feat_matrix) <= PREDICT_CHUNK_SIZE:
+        return _run_model(feat_matrix)
+    return np.concatenate([
+        _run_model(feat_matrix[start:start + PREDICT_CHUNK_SIZE])
+        for start in range(0, len(feat_matrix), PREDICT_CHUNK_SIZE)
+    ])
+
+# Micro-batching of concurrent /predict calls
+MAX_BATCH_SIZE = 64
+MAX_BATCH_WAIT = 0.005  # seconds
+
+class PredictionBatcher:
     """
-    Calculate derived features from raw stock data
+    Coalesces concurrent single-stock predictions into one model call.
+    A background thread collects queued rows until max_batch_size is
+    reached, and waits up to max_wait for more only while other requests
+    are still in flight, so a lone request is never held back.
     """
-    features = {}
     
-    # Extract raw values
-    day_change_percent = stock_data.get('day_change_percent', 0)
-    volume = stock_data.get('volume', 0)
-    market_cap = stock_data.get('market_cap', 0)
-    current_price = stock_data.get('current_price', 0)
-    previous_close = stock_data.get('previous_close', current_price)
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._pid = None
+    
+    def predict(self, feature_vector):
+        """Return the risk score for one row in FEATURE_COLUMNS order"""
+        self._ensure_started()
+        future = Future()
+        with self._lock:
+            self._in_flight += 1
+        self._queue.put((feature_vector, future))
+        return future.result()
+    
+    def _ensure_started(self):
+        # Threads do not survive fork, so each gunicorn worker starts its own
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    threading.Thread(target=self._run, daemon=True).start()
+                    self._pid = pid
+    
+    def _run(self):
+        # Rows are written into a buffer owned by this thread rather than
+        # allocating a new array per batch; leading rows stay C-contiguous
+        buffer = np.empty((self.max_batch_size, len(FEATURE_COLUMNS)), dtype=np.float32)
+        
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._in_flight <= len(batch):
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            self._predict_batch(batch, buffer)
+    
+    def _predict_batch(self, batch, buffer):
+        futures = [future for _, future in batch]
+        try:
+            for i, (row, _) in enumerate(batch):
+                buffer[i] = row
+            risk_scores = predict_scores(buffer[:len(batch)]).tolist()
+        except Exception as e:
+            risk_scores = None
+            error = e
+        
+        with self._lock:
+            self._in_flight -= len(batch)
+        
+        for i, future in enumerate(futures):
+            if risk_scores is None:
+                future.set_exception(error)
+            else:
+                future.set_result(risk_scores[i])
+
+prediction_batcher = PredictionBatcher()
+
+# Cache of recent /predict results, for repeated polls of the same stock
+# when the m2cgen scoring library is not available
+PREDICTION_CACHE_SIZE = 8192
+CACHE_KEY_DECIMALS = 3
+
+class PredictionCache:
+    """
+    Thread-safe LRU cache of risk scores keyed on quantized raw stock values.
+    The features are derived from the raw values alone, so equal keys give
+    (near) equal predictions.
+    """
     
-    # Calculate derived features
-    features['day_change_percent'] = day_change_percent
-    features['volume'] = volume if volume > 0 else 1  # Avoid division by zero
-    features['market_cap'] = market_cap if market_cap > 0 else 1
-    features['current_price'] = current_price if current_price > 0 else 1
-    features['price_volatility'] = abs(day_change_percent)
+    def __init__(self, maxsize=PREDICTION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
     
-    # Volume ratio (normalized, using a simple approach)
-    # In production, use historical average
-    features['volume_ratio'] = 1.0  # Default, should be calculated from historical data
+    @staticmethod
+    def key(raw_values):
+        """Quantized cache key for a tuple from raw_stock_values"""
+        return tuple(round(value, CACHE_KEY_DECIMALS) for value in raw_values)
     
-    # Price change ratio
-    if previous_close > 0:
-        features['price_change_ratio'] = abs(current_price - previous_close) / previous_close
-    else:
-        features['price_change_ratio'] = 0
+    def get(self, key):
+        """Return the cached score for key, or None"""
+        with self._lock:
+            risk_score = self._scores.get(key)
+            if risk_score is not None:
+                self._scores.move_to_end(key)
+            return risk_score
     
-    return features
+    def put(self, key, risk_score):
+        with self._lock:
+            self._scores[key] = risk_score
+            self._scores.move_to_end(key)
+            if len(self._scores) > self.maxsize:
+                self._scores.popitem(last=False)
+
+prediction_cache = PredictionCache()
+
+def json_response(payload, status=200):
+    """
+    Serialize a response with orjson, which also handles NumPy values
+    """
+    return app.response_class(
+        orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+        status=status,
+        mimetype='application/json'
+    )
+
+# Number of batch results serialized per streamed chunk
+STREAM_CHUNK_SIZE = 256
+
+def stream_results_response(results, count):
+    """
+    Stream {"results": [...], "count": count} from an iterator of result
+    dicts, serializing one chunk at a time. Only a chunk of result dicts
+    and its serialized bytes are held at once; the per-stock inputs and
+    scores the iterator reads from are still fully materialized.
+    """
+    def generate():
+        yield b'{"results":['
+        separator = b''
+        while True:
+            chunk = list(islice(results, STREAM_CHUNK_SIZE))
+            if not chunk:
+                break
+            # Strip the list brackets so chunks join into one JSON array
+            yield separator + orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1]
+            separator = b','
+        yield b'],"count":' + str(count).encode() + b'}'
+    
+    return app.response_class(generate(), mimetype='application/json')
 
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
-    return jsonify({
+    return json_response({
         'status': 'healthy',
         'model_loaded': model is not None
     })
@@ -84,51 +408,53 @@ def predict():
         "previous_close": 147.25
     }
     """
-    if model is None or scaler is None:
-        return jsonify({
+    if model is None:
+        return json_response({
             'error': 'Model not loaded. Please train the model first.'
-        }), 500
+        }, 500)
     
     try:
-        data = request.get_json()
+        body = request.get_data()
         
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
+        # An empty body or empty object carries no stock values
+        if b''.join(body.split()) in (b'', b'{}'):
+            return json_response({'error': 'No data provided'}, 400)
         
-        # Calculate features
-        features = calculate_features(data)
+        # Calculate features in model column order
+        raw_values = raw_stock_values(msgspec.json.decode(body, type=Stock))
+        feature_vector = build_row(raw_values)
         
-        # Prepare feature vector in correct order
-        feature_vector = [features.get(name, 0) for name in feature_names]
-        feature_array = np.array(feature_vector).reshape(1, -1)
-        
-        # Scale features
-        scaled_features = scaler.transform(feature_array)
-        
-        # Predict
-        risk_score = model.predict(scaled_features)[0]
+        # Predict with the native scoring function, which is cheaper than a
+        # cache lookup. Otherwise batch together with any concurrent requests,
+        # unless the same stock values were scored recently
+        if score_lib is not None:
+            risk_score = score_single(feature_vector)
+        else:
+            cache_key = PredictionCache.key(raw_values)
+            risk_score = prediction_cache.get(cache_key)
+            if risk_score is None:
+                risk_score = prediction_batcher.predict(feature_vector)
+                prediction_cache.put(cache_key, risk_score)
         
         # Ensure score is between 0-100
         risk_score = max(0, min(100, risk_score))
         
         # Determine risk level
-        if risk_score < 30:
-            risk_level = 'Low'
-        elif risk_score < 60:
-            risk_level = 'Medium'
-        else:
-            risk_level = 'High'
+        risk_level = RISK_LEVELS[bisect_right(RISK_THRESHOLDS, risk_score)]
         
-        return jsonify({
+        return json_response({
             'risk_score': round(float(risk_score), 2),
             'risk_level': risk_level,
-            'features_used': features
+            'features_used': dict(zip(FEATURE_COLUMNS, feature_vector))
         })
     
+    except msgspec.DecodeError as e:
+        return json_response({'error': f'Invalid request: {str(e)}'}, 400)
+    
     except Exception as e:
-        return jsonify({
+        return json_response({
             'error': f'Prediction error: {str(e)}'
-        }), 500
+        }, 500)
 
 @app.route('/predict/batch', methods=['POST'])
 def predict_batch():
@@ -150,59 +476,53 @@ def predict_batch():
         ]
     }
     """
-    if model is None or scaler is None:
-        return jsonify({
+    if model is None:
+        return json_response({
             'error': 'Model not loaded. Please train the model first.'
-        }), 500
+        }, 500)
     
     try:
-        data = request.get_json()
-        stocks = data.get('stocks', [])
+        body = request.get_data()
+        stocks = msgspec.json.decode(body, type=BatchRequest).stocks if body else []
         
         if not stocks:
-            return jsonify({'error': 'No stocks provided'}), 400
-        
-        results = []
-        
-        for stock in stocks:
-            try:
-                features = calculate_features(stock)
-                feature_vector = [features.get(name, 0) for name in feature_names]
-                feature_array = np.array(feature_vector).reshape(1, -1)
-                scaled_features = scaler.transform(feature_array)
-                risk_score = model.predict(scaled_features)[0]
-                risk_score = max(0, min(100, risk_score))
-                
-                if risk_score < 30:
-                    risk_level = 'Low'
-                elif risk_score < 60:
-                    risk_level = 'Medium'
-                else:
-                    risk_level = 'High'
-                
-                results.append({
-                    'symbol': stock.get('symbol', 'UNKNOWN'),
-                    'risk_score': round(float(risk_score), 2),
+            return json_response({'error': 'No stocks provided'}, 400)
+        
+        if len(stocks) > MAX_BATCH_STOCKS:
+            return json_response({
+                'error': f'Too many stocks, send at most {MAX_BATCH_STOCKS} per request'
+            }, 413)
+        
+        symbols = [stock.symbol for stock in stocks]
+        rows = [raw_stock_values(stock) for stock in stocks]
+        
+        # Predict the whole batch in a single call
+        risk_scores = predict_scores(calculate_features_batch(rows)).astype(np.float64)
+        np.clip(risk_scores, 0, 100, out=risk_scores)
+        risk_levels = _RISK_LEVELS_ARRAY[np.digitize(risk_scores, RISK_THRESHOLDS)].tolist()
+        risk_scores = np.round(risk_scores, 2).tolist()
+        
+        def results():
+            """Yield one result per stock, in request order"""
+            for symbol, risk_score, risk_level in zip(symbols, risk_scores, risk_levels):
+                yield {
+                    'symbol': symbol,
+                    'risk_score': risk_score,
                     'risk_level': risk_level
-                })
-            except Exception as e:
-                results.append({
-                    'symbol': stock.get('symbol', 'UNKNOWN'),
-                    'error': str(e)
-                })
-        
-        return jsonify({
-            'results': results,
-            'count': len(results)
-        })
+                }
+        
+        return stream_results_response(results(), len(stocks))
+    
+    except msgspec.DecodeError as e:
+        return json_response({'error': f'Invalid request: {str(e)}'}, 400)
     
     except Exception as e:
-        return jsonify({
+        return json_response({
             'error': f'Batch prediction error: {str(e)}'
-        }), 500
+        }, 500)
 
 if __name__ == '__main__':
-    # Run on port 5000 by default
+    # Local development only, production runs under gunicorn (see gunicorn.conf.py)
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=True)
+    app.run(host='0.0.0.0', port=port)
 
@@ -0,0 +1,31 @@
+"""
+Gunicorn configuration for the Stock Risk Prediction API
+Used by the Procfile: gunicorn -c gunicorn.conf.py api:app
+"""
+
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Default to 2 * cores + 1 workers
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# A few threads per worker so requests can overlap. /predict normally uses
+# models/risk_model_score.so; only when it is missing are concurrent calls
+# micro-batched (see PredictionBatcher in api.py). GUNICORN_THREADS=1 gives
+# sync workers
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load the app (and the model) once in the master, then fork the workers
+preload_app = True
+
+
+def pre_fork(server, worker):
+    """
+    Freeze the objects loaded by the master (the model among them) before
+    forking, so garbage collection in the workers doesn't touch their pages
+    and they stay shared copy-on-write instead of being copied per worker
+    """
+    gc.freeze()
@@ -33,7 +33,7 @@ echo "🧠 Training ML model..."
 python train_model.py
 
 # Check if model was created
-if [ -f "models/risk_model.pkl" ]; then
+if [ -f "models/risk_model.onnx" ]; then
     echo "✅ Model trained successfully!"
 else
     echo "❌ Model training failed!"
@@ -47,7 +47,7 @@ echo "To start the API server:"
 echo "  python api.py"
 echo ""
 echo "Or with gunicorn (production):"
-echo "  gunicorn -w 4 -b 0.0.0.0:5000 api:app"
+echo "  gunicorn -c gunicorn.conf.py api:app"
 echo ""
 echo "The API will be available at: http://localhost:5000"
 echo ""